@@ -13,6 +13,14 @@ import settings
 
 T = TypeVar("T")
 
+# Masks tested on every event, as plain ints
+_IN_CREATE = InotifyConstants.IN_CREATE
+_IN_MODIFY = InotifyConstants.IN_MODIFY
+_IN_MOVED_FROM = InotifyConstants.IN_MOVED_FROM
+_IN_MOVED_TO = InotifyConstants.IN_MOVED_TO
+_EX_RENAME = ExtendedInotifyConstants.EX_RENAME
+_EX_IN_MODIFY = ExtendedInotifyConstants.EX_IN_MODIFY
+
 
 class DelayedQueue(Generic[T]):
     def __init__(self, delay):
@@ -94,9 +102,10 @@ class InotifyBuffer(Thread):
         e: InotifyEvent = self._queue.get()
         if e is None:
             return
-        if e._mask & InotifyConstants.IN_MOVED_FROM and not e._mask & ExtendedInotifyConstants.EX_RENAME:
+        mask = e._mask
+        if mask & _IN_MOVED_FROM and not mask & _EX_RENAME:
             e = InotifyEvent.from_other(e, mask=InotifyConstants.IN_DELETE)  # unmatched IN_MOVED_FROM after delay
-        elif e._mask & InotifyConstants.IN_MODIFY and not e._mask & ExtendedInotifyConstants.EX_IN_MODIFY:
+        elif mask & _IN_MODIFY and not mask & _EX_IN_MODIFY:
             e = ExtendedEvent.from_other(e, mask=ExtendedInotifyConstants.EX_END_MODIFY)  # unmatched IN_MODIFY after delay
         return e
 
@@ -105,19 +114,18 @@ class InotifyBuffer(Thread):
             raw_events = self._read_raw_events()
             grouped_events = self._group_events(raw_events)
             for e in grouped_events:
-                delay = False
-                if e._mask & InotifyConstants.IN_MOVED_FROM or e._mask & ExtendedInotifyConstants.EX_RENAME:
-                    delay = True
-                elif e._mask & InotifyConstants.IN_MODIFY and not e._mask & ExtendedInotifyConstants.EX_IN_MODIFY:
-                    delay = True
+                mask = e._mask
+                delay = bool(mask & (_IN_MOVED_FROM | _EX_RENAME)) \
+                    or bool(mask & _IN_MODIFY and not mask & _EX_IN_MODIFY)
                 self._queue.put(e, delay)
 
     def _group_events(self, event_list: Iterable[InotifyEvent]) -> Iterable[InotifyEvent]:
         grouped: List[InotifyEvent] = []
         e = None
+        coalesce = settings.buffer_coalesce_modify
         for e in event_list:
             # Handle vim save with .swp
-            if e.lsb == InotifyConstants.IN_CREATE:
+            if e.lsb == _IN_CREATE:
                 check = lambda x: x._mask & ExtendedInotifyConstants.EX_RENAME and x._src_path == e._src_path
                 replace0 = lambda y: ExtendedEvent(
                     InotifyConstants.IN_CREATE, src_path=y._dest_path, event_time=y._time, override=y._mask)
@@ -132,7 +140,7 @@ class InotifyBuffer(Thread):
                         e = replace(e)
 
             # Handle rename
-            if e.lsb == InotifyConstants.IN_MOVED_TO:
+            if e.lsb == _IN_MOVED_TO:
                 check = lambda x: x.lsb == InotifyConstants.IN_MOVED_FROM and x._cookie == e._cookie
                 replace = lambda y: ExtendedEvent.from_other(
                     y, mask=ExtendedInotifyConstants.EX_RENAME|InotifyConstants.IN_MOVED_TO,
@@ -149,18 +157,25 @@ class InotifyBuffer(Thread):
                         e = InotifyEvent.from_other(e, mask=InotifyConstants.IN_CREATE)
             
             # Handle consecutive modify
-            elif e.lsb == InotifyConstants.IN_MODIFY:  # NOTE: IN_MODIFY < IN_CREATE so this works
+            elif e.lsb == _IN_MODIFY:  # NOTE: IN_MODIFY < IN_CREATE so this works
                 check = lambda x: x.lsb == InotifyConstants.IN_MODIFY and \
                     not x._mask & ExtendedInotifyConstants.EX_IN_MODIFY and \
                     x._src_path == e._src_path
                 replace = lambda y: ExtendedEvent.from_other(
                     y, mask=ExtendedInotifyConstants.EX_IN_MODIFY)
+                # Intermediate modifies (neither the first nor the last) are dropped if coalescing
+                is_middle = lambda x: coalesce and not x._mask & ExtendedInotifyConstants.EX_BEGIN_MODIFY
                 for index, e0 in enumerate(grouped):
                     if check(e0):
-                        grouped[index] = replace(e0)
+                        if is_middle(e0):
+                            del grouped[index]
+                        else:
+                            grouped[index] = replace(e0)
                         break
                 else:  # check queue
-                    if self._queue.remove(check, replace=replace) is None:  # unmatched IN_MODIFY before delay
+                    if coalesce and self._queue.remove(lambda x: check(x) and is_middle(x)) is not None:
+                        pass
+                    elif self._queue.remove(check, replace=replace) is None:  # unmatched IN_MODIFY before delay
                         e = ExtendedEvent.from_other(e, mask=ExtendedInotifyConstants.EX_BEGIN_MODIFY)
                         
             if e is not None:
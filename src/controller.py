@@ -14,7 +14,7 @@ import os.path as osp
 from datetime import datetime
 from threading import Thread, Lock, Event
 import sys
-from typing import Callable, Final
+from typing import Callable, Dict, Final
 from loguru import logger
 from dispatcher import BaseDispatcher
 from tracker import FileTracker
@@ -324,13 +324,21 @@ class MasterController:
         return fields
     
     def _emit(self, msg: str, **kwargs) -> None:
-        for route in (ExtendedEvent(ExtendedInotifyConstants.EX_META).
-                    select_routes(self._dispatcher.routes)):
+        for route in self._dispatcher.select_routes_fast(
+                ExtendedEvent(ExtendedInotifyConstants.EX_META)):
             self._dispatcher.emit(route, msg_time=datetime.now(), msg=msg, **kwargs)
     
     def signal_inotify_stats(self, name: str, num: int = 1) -> None:
         Thread(target=self._signal_inotify_stats, args=(name, num)).start()
 
+    def signal_inotify_stats_bulk(self, counts: Dict[str, int]) -> None:
+        """Same as `signal_inotify_stats` for each item of `counts`, in one thread."""
+        Thread(target=self._signal_inotify_stats_bulk, args=(counts,)).start()
+
+    def _signal_inotify_stats_bulk(self, counts: Dict[str, int]) -> None:
+        for name, num in counts.items():
+            self._signal_inotify_stats(name, num)
+
     def _signal_inotify_stats(self, name: str, num: int = 1) -> None:
         with self._lock:
             if name not in self._stats:
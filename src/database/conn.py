@@ -4,7 +4,8 @@ from math import modf
 from datetime import datetime
 from time import time
 from typing import Callable, List
-from threading import Thread, Lock, Semaphore, Event
+from threading import Thread, Lock, Semaphore, Event, Condition, current_thread
+from collections import deque
 if macros.LIB_SQL == 'mysql.connector':
     import mysql.connector as libsql
     from mysql.connector.connection import MySQLConnection
@@ -15,7 +16,6 @@ elif macros.LIB_SQL == 'pymysql':
     from pymysql.connections import Connection as MySQLConnection
     from pymysql.cursors import Cursor as MySQLCursor
     from database.pymysqlpool import ConnectionPool as MySQLConnectionPool
-from queue import Queue
 import os
 from event import InotifyEvent, ExtendedEvent
 from loguru import logger
@@ -217,42 +217,81 @@ class ConnectionThread(Thread):
 
 
 class SQLEventLogger(Thread, SQLConnection):
+    """
+    Record events into database in a thread of its own. Workers only queue events;
+    the logger takes all queued events (up to `_max_batch`) and inserts them in one
+    transaction, falling back to one transaction per event if that fails.
+    """
     def __init__(self):
         Thread.__init__(self)
         SQLConnection.__init__(self)
         self._ndigits_microsec = 6
         self._ndigits_uid = 4
         self._max_retry = 3
+        self._max_batch = 128
+        self._linger = float(settings.db_log_linger)
         if not self.enabled:
             logger.warning('SQL is not enabled. Events will not be recorded in database.')
-        self._queue = Queue()
+        # Plain deque + condition; queue.Queue locks twice per put / get
+        self._queue = deque()
+        self._not_empty = Condition(Lock())
         self._stopped_event = Event()
+        self._start_pending = False
+        self._start_lock = Lock()
 
     def start(self):
-        if self.enabled:
-            Thread.start(self)
+        """Start recording. The thread, and the connection, are only created on the first event,
+        so idle workers (e.g., with `worker_every_path`) do not hold them."""
+        self._start_pending = self.enabled
+
+    def _start_thread(self):
+        with self._start_lock:
+            if self._start_pending:
+                self._start_pending = False
+                Thread.start(self)
 
     def run(self) -> None:
-        while not self._stopped_event.is_set():
-            event = self._queue.get()
-            if event is None:
+        queue, popleft = self._queue, self._queue.popleft
+        stopped = False
+        while not stopped:
+            # Take all queued events (up to `_max_batch`) and record them in one transaction
+            with self._not_empty:
+                while not queue:
+                    self._not_empty.wait()
+                # Linger a little so that a burst of events shares one transaction
+                deadline = time() + self._linger
+                while len(queue) < self._max_batch and (timeout := deadline - time()) > 0:
+                    self._not_empty.wait(timeout)
+                events = [popleft() for _ in range(min(len(queue), self._max_batch))]
+            if None in events:  # stopped; events queued before are still recorded
+                stopped = True
+                events = [event for event in events if event is not None]
+            if not events:
                 continue
-            for _ in range(self._max_retry+1):
-                try:
-                    self._log_event(event)
-                    break
-                except:
-                    pass
-            else:
-                logger.warning(f'Cannot record {event} into table logs. Max retry exceeds')
-                try:
-                    self._log_event(event, direct_to_aux=True)
-                except Exception as e:
-                    logger.error(f'Cannot record {repr(event)} into table aux_logs either: '
-                                    f'{e.__class__.__name__} "{e}"')
+            try:
+                self._log_events(events)
+            except:
+                # Retry one by one, so that a bad event does not fail the others
+                for event in events:
+                    self._log_event_with_retry(event)
             if macros.TEST_SQL_DELAY:
-                elapsed = time() - event._time
-                logger.trace(f'SQL delayed {elapsed} secs')
+                elapsed = time() - events[0]._time
+                logger.trace(f'SQL delayed {elapsed} secs ({len(events)} events)')
+
+    def _log_event_with_retry(self, event: InotifyEvent) -> None:
+        for _ in range(self._max_retry+1):
+            try:
+                self._log_event(event)
+                break
+            except:
+                pass
+        else:
+            logger.warning(f'Cannot record {event} into table logs. Max retry exceeds')
+            try:
+                self._log_event(event, direct_to_aux=True)
+            except Exception as e:
+                logger.error(f'Cannot record {repr(event)} into table aux_logs either: '
+                                f'{e.__class__.__name__} "{e}"')
 
     def _timestamp_to_decimal(self, timestamp):
         microsec, sec = modf(timestamp)
@@ -262,38 +301,51 @@ class SQLEventLogger(Thread, SQLConnection):
     def log_event(self, event: InotifyEvent):
         if not self.enabled:
             return
-        self._queue.put(event)
+        if self._start_pending:
+            self._start_thread()
+        with self._not_empty:
+            self._queue.append(event)
+            self._not_empty.notify()
     
     @ConnectionSingleton.lazy_init
     def _log_event(self, event: InotifyEvent, direct_to_aux: bool = False) -> None:
-        microsec, sec = self._timestamp_to_decimal(event._time)
+        with self.transaction() as cursor:
+            self._insert_event(cursor, event, direct_to_aux)
 
+    @ConnectionSingleton.lazy_init
+    def _log_events(self, events: List[InotifyEvent]) -> None:
         with self.transaction() as cursor:
-            inc_id = 0
-            if not direct_to_aux:
-                cursor.execute(
-                    'SELECT unique_time FROM logs '
-                    'WHERE unique_time >= %s AND unique_time < %s '
-                    'ORDER BY unique_time DESC LIMIT 1',
-                    (f'{sec}.{microsec}', f'{sec}.{microsec+1}'))
-                ret = cursor.fetchone()
-                if ret is not None:
-                    latest, = ret
-                    inc_id = int(str(latest)[-self._ndigits_uid:]) + 1
-
-            if direct_to_aux or inc_id == 10**self._ndigits_uid:
-                # In case we run out of 10000 uids within one microsecond
-                # NOTE: This occasion is rarely encountered
-                cursor.execute(
-                    'INSERT INTO aux_logs (time, mask, src_path, dest_path, monitor_pid)'
-                    'VALUES (%s, %s, %s, %s, %s)',
-                    (f'{sec}.{microsec}', event._mask, event._src_path, event._dest_path, self._pid))
-            else:
-                cursor.execute(
-                    'INSERT INTO logs (unique_time, mask, src_path, dest_path, monitor_pid)'
-                    'VALUES (%s, %s, %s, %s, %s)',
-                    (f'{sec}.{microsec}{inc_id:0{self._ndigits_uid}d}', event._mask, event._src_path, event._dest_path, self._pid))
-                
+            for event in events:
+                self._insert_event(cursor, event)
+
+    def _insert_event(self, cursor, event: InotifyEvent, direct_to_aux: bool = False) -> None:
+        microsec, sec = self._timestamp_to_decimal(event._time)
+
+        inc_id = 0
+        if not direct_to_aux:
+            cursor.execute(
+                'SELECT unique_time FROM logs '
+                'WHERE unique_time >= %s AND unique_time < %s '
+                'ORDER BY unique_time DESC LIMIT 1',
+                (f'{sec}.{microsec}', f'{sec}.{microsec+1}'))
+            ret = cursor.fetchone()
+            if ret is not None:
+                latest, = ret
+                inc_id = int(str(latest)[-self._ndigits_uid:]) + 1
+
+        if direct_to_aux or inc_id == 10**self._ndigits_uid:
+            # In case we run out of 10000 uids within one microsecond
+            # NOTE: This occasion is rarely encountered
+            cursor.execute(
+                'INSERT INTO aux_logs (time, mask, src_path, dest_path, monitor_pid)'
+                'VALUES (%s, %s, %s, %s, %s)',
+                (f'{sec}.{microsec}', event._mask, event._src_path, event._dest_path, self._pid))
+        else:
+            cursor.execute(
+                'INSERT INTO logs (unique_time, mask, src_path, dest_path, monitor_pid)'
+                'VALUES (%s, %s, %s, %s, %s)',
+                (f'{sec}.{microsec}{inc_id:0{self._ndigits_uid}d}', event._mask, event._src_path, event._dest_path, self._pid))
+            
     @ConnectionSingleton.lazy_init
     def query_event(self, from_time: datetime = None, to_time: datetime = None,
                     pattern: str = None, mask: int = None, pid: int = None) -> List[InotifyEvent]:
@@ -326,6 +378,14 @@ class SQLEventLogger(Thread, SQLConnection):
         return events
 
     def stop(self):
+        with self._start_lock:
+            if self._start_pending and self._queue:  # events queued, but the thread not yet started
+                Thread.start(self)
+            self._start_pending = False
+        with self._not_empty:
+            self._queue.append(None)
+            self._not_empty.notify()
+        if self.is_alive() and current_thread() is not self:
+            self.join()  # record the queued events before closing the connection
         self.close_conn()
-        self._queue.put(None)
         self._stopped_event.set()
@@ -4,56 +4,172 @@ import settings
 from typing import Iterable
 import re
 import os
-from functools import reduce
+import atexit
+from functools import lru_cache
 from typing import List, Tuple, Iterator, Dict
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
 from event import ExtendedInotifyConstants
-from threading import Lock
+from threading import Lock, Thread, Event, local
+from queue import Queue, SimpleQueue, Empty, Full
 import settings
 from loguru import logger
 from scheduler import BaseScheduler, HistogramScheduler, ProxyScheduler
 import utils
+try:
+    import re._parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse
 
 
-_name_to_scheduler: Dict[str, BaseScheduler] = {
-    '': ProxyScheduler, 'direct': ProxyScheduler, 'proxy': ProxyScheduler,
-    'hist': HistogramScheduler, 'histogram': HistogramScheduler
+def _dumps(obj) -> bytes:
+    """
+    Serialize `obj` into compact UTF-8 JSON, e.g., `{"tag":"logs","msg":"..."}`, the same
+    with or without orjson. If any string is not valid UTF-8 (e.g., an undecodable path),
+    the whole message is ASCII with `\\uXXXX` escapes instead.
+    """
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+    except (TypeError, UnicodeEncodeError):  # surrogates in str; orjson.JSONEncodeError is a TypeError
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def _literal_hint(pattern: re.Pattern) -> bytes:
+    """
+    Return the longest literal run that any match of `pattern` must contain,
+    or `b''` if none can be found cheaply.
+    """
+    if pattern.flags & re.IGNORECASE:
+        return b''
+    try:
+        parsed = _sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return b''
+    best, run = [], []
+    for op, av in parsed:
+        if op is _sre_parse.LITERAL:
+            run.append(av)
+            continue
+        if len(run) > len(best):
+            best = run
+        run = []
+    if len(run) > len(best):
+        best = run
+    return bytes(best)
+
+
+class _MultiMatcher:
+    """Fullmatch a path against all route patterns in one hyperscan pass."""
+    def __init__(self, patterns: List[re.Pattern]) -> None:
+        flags = []
+        for pattern in patterns:
+            if pattern.flags & re.VERBOSE:
+                raise ValueError(f'Unsupported flags of pattern {pattern.pattern!r}')
+            flag = hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_ALLOWEMPTY
+            if pattern.flags & re.IGNORECASE:
+                flag |= hyperscan.HS_FLAG_CASELESS
+            if pattern.flags & re.DOTALL:
+                flag |= hyperscan.HS_FLAG_DOTALL
+            if pattern.flags & re.MULTILINE:
+                flag |= hyperscan.HS_FLAG_MULTILINE
+            flags.append(flag)
+        self._db = hyperscan.Database()
+        self._db.compile(
+            expressions=[rb'\A(?:' + pattern.pattern + rb')\z' for pattern in patterns],
+            ids=list(range(len(patterns))), elements=len(patterns), flags=flags)
+        self._scratch = hyperscan.Scratch(self._db)
+        self._local = local()  # scratch space cannot be shared among threads
+
+    @staticmethod
+    def _on_match(id, start, end, flags, matched) -> None:
+        matched.append(id)
+
+    def __call__(self, path: bytes) -> frozenset:
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            scratch = self._local.scratch = self._scratch.clone()
+        matched = []
+        self._db.scan(path, match_event_handler=self._on_match, context=matched, scratch=scratch)
+        return frozenset(matched)
+
+
+_mask_by_name: Dict[str, int] = {
+    name: getattr(ExtendedInotifyConstants, name)
+    for name in dir(ExtendedInotifyConstants) if not name.startswith('_')}
+
+# Scheduler name -> (scheduler class, converters of its positional args after `callback`)
+_scheduler_specs: Dict[str, Tuple[type, tuple]] = {
+    '': (ProxyScheduler, ()), 'direct': (ProxyScheduler, ()), 'proxy': (ProxyScheduler, ()),
+    'hist': (HistogramScheduler, (int, int, str)), 'histogram': (HistogramScheduler, (int, int, str))
 }
 
 
 class Route:
     def __init__(self, tag: str, pattern: re.Pattern, event: int, format: str,
-                 scheduler: BaseScheduler) -> None:
+                 scheduler: BaseScheduler, format_fn=None) -> None:
         self.tag = tag
         self.title = ''
         self.description = ''
         self.pattern = pattern
         self.event = event
         self.format = format
+        self.format_fn = format_fn or utils.compile_format(format)
+        self.literal_hint = _literal_hint(pattern)
         self.scheduler = scheduler
         scheduler.route = self
 
     @staticmethod
     def parse_mask_from_str(event: str) -> int:
-        return reduce(
-            lambda x, y: x | y,
-            [getattr(ExtendedInotifyConstants, e) if e else 0 for e in event.split('|')]
-        )
+        masks = _mask_by_name
+        mask = 0
+        for e in event.split('|'):
+            if e:
+                mask |= masks[e]
+        return mask
+
+    @staticmethod
+    def parse_route_defs() -> List[tuple]:
+        """
+        Parse route settings into `(tag, pattern, event, format, format_fn, scheduler, args)`
+        tuples. The result is cached until any of the route settings changes.
+        """
+        global _route_defs_cache
+        key = tuple(tuple(opt) for opt in (
+            settings.route_tags, settings.route_patterns,
+            settings.route_events, settings.route_formats, settings.route_schedulers))
+        if _route_defs_cache is not None and _route_defs_cache[0] == key:
+            return _route_defs_cache[1]
+        defs = []
+        append, parse_mask, compile_format = defs.append, Route.parse_mask_from_str, utils.compile_format
+        for tag, pattern, event, format, scheduler in zip(*key):
+            name, *args = scheduler.split(' ')
+            scheduler, converters = _scheduler_specs[name]
+            if len(args) > len(converters):
+                raise ValueError(f'Too many arguments for scheduler {name!r}: {args}')
+            args = [conv(arg) for conv, arg in zip(converters, args)]
+            append((tag, re.compile(os.fsencode(pattern)), parse_mask(event),
+                    format, compile_format(format), scheduler, args))
+        _route_defs_cache = key, defs
+        return defs
 
     @classmethod
     def parse_routes(cls, callback) -> Iterator['Route']:
-        for tag, pattern, event, format, scheduler in zip(
-                settings.route_tags, settings.route_patterns,
-                settings.route_events, settings.route_formats, settings.route_schedulers):
-            pattern = re.compile(os.fsencode(pattern))
-            event = Route.parse_mask_from_str(event)
-            scheduler = scheduler.split(' ')
-            scheduler, args = scheduler[0], scheduler[1:]
-            args = [int(arg) if i < 2 else arg for i, arg in enumerate(args)]  # TODO: use argparser
-            scheduler = _name_to_scheduler[scheduler](
-                callback, *args)
+        for tag, pattern, event, format, format_fn, scheduler, args in cls.parse_route_defs():
+            scheduler = scheduler(callback, *args)
             logger.info(f'Using scheduler {scheduler} for route {tag}')
-            yield Route(tag, pattern, event, format, scheduler)
+            yield Route(tag, pattern, event, format, scheduler, format_fn)
+
+
+_route_defs_cache: Tuple[tuple, List[tuple]] = None
 
 
 class BaseDispatcher:
@@ -62,6 +178,77 @@ class BaseDispatcher:
         self._pid = os.getpid()
         self._name = name
 
+        # Hot fields of routes, and indices of routes listening to each event bit, for `select_routes_fast`
+        self._route_entries = [
+            (route.literal_hint, self._cached_fullmatch(route.pattern), route) for route in self.routes]
+        self._route_ids_for_bit: Dict[int, List[int]] = {}
+        for i, route in enumerate(self.routes):
+            m = route.event
+            while m:
+                bit = m & -m
+                self._route_ids_for_bit.setdefault(bit, []).append(i)
+                m ^= bit
+        self._route_ids_for_mask: Dict[int, Tuple[int, ...]] = {}
+        self._multi_match = self._build_multi_matcher([route.pattern for route in self.routes])
+
+    @staticmethod
+    def _build_multi_matcher(patterns: List[re.Pattern]):
+        """Return a function mapping a path to the indices of all fullmatched patterns, if hyperscan is usable."""
+        if hyperscan is None or not settings.route_hyperscan or not patterns:
+            return None
+        try:
+            multi_match = _MultiMatcher(patterns)
+        except Exception as e:
+            logger.warning(f'Cannot compile route patterns with hyperscan, using re instead: '
+                           f'{e.__class__.__name__} "{e}"')
+            return None
+        cachesize = int(settings.route_match_cachesize)
+        if cachesize > 0:
+            multi_match = lru_cache(maxsize=cachesize)(multi_match)
+        return multi_match
+
+    @staticmethod
+    def _cached_fullmatch(pattern: re.Pattern):
+        """Memoize `pattern.fullmatch` on paths, since bursts of events usually hit the same files."""
+        fullmatch, cachesize = pattern.fullmatch, int(settings.route_match_cachesize)
+        if cachesize <= 0:
+            return fullmatch
+        return lru_cache(maxsize=cachesize)(lambda path: fullmatch(path) is not None)
+
+    def _select_route_ids(self, mask: int) -> Tuple[int, ...]:
+        """Indices of routes listening to any bit of `mask`, in the order of routes."""
+        ids_for_bit = self._route_ids_for_bit
+        ids = set()
+        while mask:
+            bit = mask & -mask
+            if bit in ids_for_bit:
+                ids.update(ids_for_bit[bit])
+            mask ^= bit
+        return tuple(sorted(ids))
+
+    def select_routes_fast(self, event, alt_paths: Iterable = ()) -> Iterator[Route]:
+        """Same as `event.select_routes(self.routes, alt_paths)`."""
+        mask = event._mask
+        ids = self._route_ids_for_mask.get(mask)
+        if ids is None:
+            ids = self._route_ids_for_mask[mask] = self._select_route_ids(mask)
+        if not ids:
+            return
+        paths = [path for path in (event._src_path, event._dest_path, *alt_paths) if path is not None]
+        entries = self._route_entries
+        if self._multi_match is not None:
+            matched = frozenset().union(*map(self._multi_match, paths))
+            for i in ids:
+                if i in matched:
+                    yield entries[i][2]
+            return
+        for i in ids:
+            hint, fullmatch, route = entries[i]
+            for path in paths:
+                if hint in path and fullmatch(path):
+                    yield route
+                    break
+
     def start(self) -> None:
         for route in self.routes:
             route.scheduler.start()
@@ -96,48 +283,188 @@ class RedisDispatcher(BaseDispatcher):
         self._lock = Lock()
     
     def _emit(self, route: Route, data: dict) -> None:
-        tag, title, msg = route.tag, route.title, utils.format(route.format, **data)
+        tag, title, msg = route.tag, route.title, route.format_fn(data)
         for group in self._groups.get(tag, [self._default_group]):
             d = notify_redis_store.gen_data_message(tag, group, title, msg)
-            self._alert.add(json.dumps(d))
+            self._alert.add(_dumps(d))
 
 
 class LocalDispatcher(BaseDispatcher):
+    """
+    Append messages to `.fswatch.{tag}.buf` files.
+
+    Each tag has a queue drained by its own writer thread, which writes all pending
+    messages with one `writev` call, so emitting threads never wait on file I/O.
+    """
+    _max_batch = 512  # below IOV_MAX
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self._lock = Lock()
         self._fs = {}
+        self._queues = {}
+        self._writers = {}
         for tag in settings.route_tags:
             self._fs[tag] = open(f'.fswatch.{tag}.buf', 'ab')
+            self._queues[tag] = SimpleQueue()
+            self._writers[tag] = Thread(target=self._write_loop, args=(self._fs[tag], self._queues[tag]), daemon=True)
+        atexit.register(self.close)  # flush pending messages if `close` is never called
+
+    def start(self) -> None:
+        super().start()
+        for writer in self._writers.values():
+            writer.start()
+
+    @classmethod
+    def _write_loop(cls, f, queue: SimpleQueue) -> None:
+        fd = f.fileno()
+        stopped = False
+        while not stopped:
+            bufs = [queue.get()]
+            while len(bufs) < cls._max_batch:
+                try:
+                    bufs.append(queue.get_nowait())
+                except Empty:
+                    break
+            if None in bufs:  # closed
+                stopped = True
+                bufs = [buf for buf in bufs if buf is not None]
+            if not bufs:
+                continue
+            n = os.writev(fd, bufs)
+            if n < sum(map(len, bufs)):  # short write
+                rest = b''.join(bufs)[n:]
+                while rest:
+                    rest = rest[os.write(fd, rest):]
 
     def _emit(self, route: Route, data: dict) -> None:
-        tag, title, msg = route.tag, route.title, utils.format(route.format, **data)
-        f = self._fs[tag]
-        with self._lock:
-            f.write((msg + '\n').encode())
-            f.flush()
+        tag, title, msg = route.tag, route.title, route.format_fn(data)
+        self._queues[tag].put((msg + '\n').encode())
 
     def close(self) -> None:
+        atexit.unregister(self.close)
+        for queue in self._queues.values():
+            queue.put(None)
+        for writer in self._writers.values():
+            if writer.is_alive():
+                writer.join()
         for f in self._fs.values():
             f.close()
 
 
 class RabbitDispatcher(BaseDispatcher):
+    """
+    Publish messages through an asynchronous `pika.SelectConnection`.
+
+    The connection's ioloop runs in its own thread; `_emit` only queues the message
+    and wakes the ioloop, which publishes all queued messages with publisher confirms.
+    If the broker cannot be reached or the connection is lost, the thread reconnects
+    after `_reconnect_delay` seconds; meanwhile at most `_max_pending` messages are kept.
+    """
+    _max_pending = 100000
+    _reconnect_delay = 5
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         import pika
-        self._connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host='localhost', heartbeat=0))
-        self._channel = self._connection.channel()
+        self._pika = pika
+        self._queue = Queue(self._max_pending)
+        self._dropping = False  # if messages are being dropped as the queue is full
+        self._channel = None  # set once the exchange is declared
+        self._closed_event = Event()
+        self._connection_lock = Lock()  # `_connection` is replaced on reconnecting
+        self._connection = self._connect()
+        self._ioloop_thread = Thread(target=self._run_ioloop, daemon=True)
+        self._ioloop_thread.start()
+
+    def _connect(self):
+        return self._pika.SelectConnection(
+            self._pika.ConnectionParameters(host='localhost', heartbeat=0),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed)
+
+    def _run_ioloop(self) -> None:
+        while True:
+            self._connection.ioloop.start()  # until the connection is closed
+            self._closed_event.wait(self._reconnect_delay)
+            with self._connection_lock:
+                if self._closed_event.is_set():
+                    break
+                logger.info(f'{self.__class__.__name__}: Reconnecting to RabbitMQ')
+                self._connection = self._connect()
+
+    def _on_connection_open(self, connection) -> None:
+        logger.success(f'{self.__class__.__name__}: Connected to RabbitMQ')
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, err) -> None:
+        logger.error(f'{self.__class__.__name__}: Cannot connect to RabbitMQ: {err!r}'
+                     + ('' if self._closed_event.is_set() else f'; retry in {self._reconnect_delay} secs'))
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason) -> None:
+        self._channel = None
+        if not self._closed_event.is_set():
+            logger.error(f'{self.__class__.__name__}: Connection to RabbitMQ lost: {reason!r}; '
+                         f'retry in {self._reconnect_delay} secs')
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel) -> None:
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.exchange_declare(exchange='logs', exchange_type='fanout',
+                                 callback=lambda frame: self._on_exchange_declared(channel))
+
+    def _on_channel_closed(self, channel, reason) -> None:
+        self._channel = None
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()  # and reconnect
+
+    def _on_exchange_declared(self, channel) -> None:
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        self._channel = channel
+        self._publish()  # messages emitted before the channel was ready
+
+    def _on_delivery_confirmation(self, frame) -> None:
+        if frame.method.NAME == 'Basic.Nack':
+            logger.warning(f'{self.__class__.__name__}: Message {frame.method.delivery_tag} rejected by broker')
+
+    def _publish(self) -> None:
+        """Publish all queued messages. Runs in the ioloop thread."""
+        if self._channel is None:
+            return
+        while True:
+            try:
+                msg = self._queue.get_nowait()
+            except Empty:
+                break
+            self._channel.basic_publish(exchange='logs', routing_key='', body=msg)
+        self._dropping = False
 
-        self._channel.exchange_declare(exchange='logs', exchange_type='fanout')
+    def _close(self) -> None:
+        if self._connection.is_closing or self._connection.is_closed:
+            self._connection.ioloop.stop()
+        else:
+            self._connection.close()
 
     def _emit(self, route: Route, data: dict) -> None:
-        tag, title, msg = route.tag, route.title, utils.format(route.format, **data)
-        self._channel.basic_publish(exchange='logs', routing_key='', body=msg)
+        if self._closed_event.is_set():
+            raise ConnectionError(f'{self.__class__.__name__} is closed')
+        tag, title, msg = route.tag, route.title, route.format_fn(data)
+        try:
+            self._queue.put_nowait(msg)
+        except Full:
+            if not self._dropping:
+                self._dropping = True
+                logger.error(f'{self.__class__.__name__}: {self._max_pending} messages are pending; '
+                             f'dropping new messages until RabbitMQ is reachable')
+            return
+        self._connection.ioloop.add_callback_threadsafe(self._publish)
     
     def close(self) -> None:
-        self._channel.close()
+        with self._connection_lock:
+            self._closed_event.set()
+            self._connection.ioloop.add_callback_threadsafe(self._close)
+        self._ioloop_thread.join()
 
 
 def Dispatcher(*args, **kwargs) -> BaseDispatcher:
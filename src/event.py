@@ -1,11 +1,14 @@
 import os
 import os.path as osp
 import re
-from typing import Iterable, List, Tuple, Iterator
+from functools import lru_cache
+from stat import S_ISDIR, S_ISREG, S_ISLNK
+from typing import Iterable, List, Tuple, Iterator, Dict
 from time import time
 from linux import InotifyConstants
 from loguru import logger
 from datetime import datetime
+from threading import Lock
 
 
 __all__ = ['ExtendedInotifyConstants', 'InotifyEvent', 'ExtendedEvent']
@@ -35,7 +38,129 @@ _tr_zh = {
 }
 
 
+# Masks of the `InotifyEvent.is_*` tests, so that they are not rebuilt on each access
+_CREATE_DIR_MASK = InotifyConstants.IN_ISDIR | InotifyConstants.IN_CREATE
+_MOVETO_DIR_MASK = InotifyConstants.IN_ISDIR | InotifyConstants.IN_MOVED_TO
+_ATTRIB_DIR_MASK = InotifyConstants.IN_ISDIR | InotifyConstants.IN_ATTRIB
+_MOVE_DIR_MASK = InotifyConstants.IN_ISDIR | InotifyConstants.IN_MOVED_FROM
+_DELETE_FILE_MASK = InotifyConstants.IN_DELETE | InotifyConstants.IN_MOVED_FROM
+_CREATE_LINK_MASK = InotifyConstants.IN_CREATE | InotifyConstants.IN_MOVED_TO
+_INVALID_MASK = InotifyConstants.IN_DELETE | InotifyConstants.IN_DELETE_SELF | InotifyConstants.IN_MOVED_FROM
+
+# Mask-only classification of events (`InotifyEvent._kind`), so the worker tests one int per event.
+#   The *_FILE and *_LINK kinds are candidates only; the `is_*` tests still stat the path.
+KIND_CREATE_DIR = 1 << 0
+KIND_ATTRIB_DIR = 1 << 1
+KIND_MOVE_DIR = 1 << 2
+KIND_DELETE_WATCH = 1 << 3
+KIND_MOVE_WATCH = 1 << 4
+KIND_DELETE_FILE = 1 << 5
+KIND_CREATE_FILE = 1 << 6
+KIND_MODIFY_FILE = 1 << 7
+KIND_MOVETO_FILE = 1 << 8
+KIND_CREATE_LINK = 1 << 9
+KIND_MODIFY_LINK = 1 << 10
+
+@lru_cache(maxsize=256)
+def _kind_of_mask(mask: int) -> int:
+    kind = 0
+    if mask & _CREATE_DIR_MASK == _CREATE_DIR_MASK or mask & _MOVETO_DIR_MASK == _MOVETO_DIR_MASK:
+        kind |= KIND_CREATE_DIR
+    if mask & _ATTRIB_DIR_MASK == _ATTRIB_DIR_MASK:
+        kind |= KIND_ATTRIB_DIR
+    if mask & _MOVE_DIR_MASK == _MOVE_DIR_MASK:
+        kind |= KIND_MOVE_DIR
+    if mask & InotifyConstants.IN_DELETE_SELF:
+        kind |= KIND_DELETE_WATCH
+    if mask & InotifyConstants.IN_MOVE_SELF:
+        kind |= KIND_MOVE_WATCH
+    if mask & _MOVETO_DIR_MASK == InotifyConstants.IN_MOVED_TO:
+        kind |= KIND_MOVETO_FILE
+    if not mask & InotifyConstants.IN_ISDIR:
+        if mask & _DELETE_FILE_MASK:
+            kind |= KIND_DELETE_FILE
+        if mask & InotifyConstants.IN_CREATE:
+            kind |= KIND_CREATE_FILE
+        if mask & ExtendedInotifyConstants.EX_END_MODIFY:
+            kind |= KIND_MODIFY_FILE
+        if mask & _CREATE_LINK_MASK:
+            kind |= KIND_CREATE_LINK
+        if mask & InotifyConstants.IN_MODIFY:
+            kind |= KIND_MODIFY_LINK
+    return kind
+
+_NOT_STATED = object()
+
+# Names of single-bit masks, looked up by walking the set bits of an event mask,
+#   and of the few multi-bit masks (e.g., IN_MOVE, EX_ALL_EX_EVENTS), tested as a whole
+_named_masks = {name: getattr(ExtendedInotifyConstants, name)
+                for name in dir(ExtendedInotifyConstants) if not name.startswith('_')}
+_name_for_bit = {mask: name for name, mask in _named_masks.items() if mask & (mask - 1) == 0}
+_multibit_masks = tuple((mask, name) for name, mask in _named_masks.items() if mask & (mask - 1))
+
+@lru_cache(maxsize=256)  # only a few combinations of bits occur in practice
+def _full_event_name(mask: int) -> str:
+    masks = [name for m, name in _multibit_masks if mask & m == m]
+    m = mask
+    while m:
+        bit = m & -m
+        if bit in _name_for_bit:
+            masks.append(_name_for_bit[bit])
+        m ^= bit
+    return '|'.join(sorted(masks))
+
+
+# Candidates of `event_name`, in order of priority; extended events are named only if no inotify event is
+_in_event_names = tuple((getattr(InotifyConstants, name), name) for name in (
+    'IN_ACCESS', 'IN_MODIFY', 'IN_ATTRIB', 'IN_CLOSE_WRITE',
+    'IN_CLOSE_NOWRITE','IN_OPEN', 'IN_MOVED_FROM', 'IN_MOVED_TO',
+    'IN_DELETE', 'IN_CREATE', 'IN_DELETE_SELF', 'IN_MOVE_SELF',
+    'IN_UNMOUNT', 'IN_Q_OVERFLOW', 'IN_IGNORED'))
+_in_event_name_for_bit = dict(_in_event_names)
+_in_event_names_mask = sum(_in_event_name_for_bit)
+_ex_event_names = tuple((getattr(ExtendedInotifyConstants, name), name) for name in (
+    'EX_RENAME', 'EX_MODIFY_CONFIG',
+    'EX_BEGIN_MODIFY', 'EX_IN_MODIFY', 'EX_END_MODIFY'))
+
+
+class _LazyDatetime:
+    """`datetime.fromtimestamp(timestamp)`, built only when it is formatted or used."""
+    __slots__ = ('timestamp', '_datetime')
+
+    def __init__(self, timestamp: float) -> None:
+        self.timestamp = timestamp
+        self._datetime = None
+
+    @property
+    def datetime(self) -> datetime:
+        if self._datetime is None:
+            self._datetime = datetime.fromtimestamp(self.timestamp)
+        return self._datetime
+
+    def __getattr__(self, name):
+        return getattr(self.datetime, name)
+
+    def __format__(self, format_spec: str) -> str:
+        return format(self.datetime, format_spec)
+
+    def __str__(self) -> str:
+        return str(self.datetime)
+
+    def __repr__(self) -> str:
+        return repr(self.datetime)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, _LazyDatetime):
+            return self.timestamp == other.timestamp
+        return self.datetime == other
+
+    def __hash__(self) -> int:
+        return hash(self.datetime)
+
+
 class LinuxProcess:
+    __slots__ = ('_pid', '_exe')
+
     def __init__(self, pid: str) -> None:
         self._pid = pid
         try:
@@ -43,32 +168,62 @@ class LinuxProcess:
         except:
             self._exe = None
 
+    # Open files of all processes, rescanned at most once per `_scan_ttl` seconds
+    #   so that bursts of events share one walk of /proc
+    _scan_ttl = 0.5
+    _scan_time = 0.
+    _pids_for_file: Dict[str, List[str]] = {}
+    _scan_lock = Lock()
+
     @staticmethod
-    def get_procs_by_filename(path: str) -> Iterator['LinuxProcess']:
+    def _scan_open_files() -> Dict[str, List[str]]:
+        pids_for_file = {}
         try:
-            pids = os.listdir('/proc')
+            procs = os.scandir('/proc')
         except:
-            return
-        for pid in pids:
-            if not pid.isdigit():
-                continue
-            try:
-                fds = os.listdir(f'/proc/{pid}/fd')
-            except:
-                continue
-            for fd in fds:
+            return pids_for_file
+        with procs:
+            for proc in procs:
+                if not proc.name.isdigit():
+                    continue
                 try:
-                    if os.readlink(f'/proc/{pid}/fd/{fd}') == path:
-                        yield LinuxProcess(pid)
-                        break
+                    fds = os.scandir(f'{proc.path}/fd')
                 except:
-                    pass
+                    continue
+                files = set()
+                with fds:
+                    try:
+                        for fd in fds:
+                            try:
+                                files.add(os.readlink(fd.path))
+                            except:
+                                pass
+                    except:  # the process exited while listing
+                        pass
+                for file in files:
+                    pids_for_file.setdefault(file, []).append(proc.name)
+        return pids_for_file
+
+    @classmethod
+    def get_procs_by_filename(cls, path: str) -> Iterator['LinuxProcess']:
+        with cls._scan_lock:
+            now = time()
+            if now - cls._scan_time >= cls._scan_ttl:
+                cls._pids_for_file = cls._scan_open_files()
+                cls._scan_time = now
+            pids = cls._pids_for_file.get(path, ())
+        for pid in pids:
+            yield LinuxProcess(pid)
 
     def __str__(self) -> str:
         return self._pid
 
 
 class InotifyEvent:
+    __slots__ = ('_wd', '_mask', '_cookie', '_name', '_src_path', '_dest_path', '_time', '_proc',
+                 '_override', 'lsb', '_significant_bit', '_event_name', '_lstat', '_stat', '_fields',
+                 '_src_str', '_dest_str', '_kind')
+
     def __init__(self, wd, mask, cookie, name, src_path, dest_path = None, event_time: float = None, override: int = 0) -> None:
         self._wd = wd
         self._mask = mask
@@ -79,10 +234,13 @@ class InotifyEvent:
         self._time = time() if event_time is None else event_time
         self._proc = None
         self._override = override
+        self._kind = _kind_of_mask(mask)
 
         self.lsb = self._mask & -self._mask
         self._significant_bit = self.lsb
         self._event_name = None
+        self._lstat = self._stat = _NOT_STATED
+        self._src_str = self._dest_str = None  # decoded paths, filled on first access
 
         self._fields = {}
 
@@ -100,92 +258,125 @@ class InotifyEvent:
         )
 
     def select_routes(self, routes: Iterable, alt_paths: Iterable = ()) -> Iterator:
-        paths = [self._src_path, self._dest_path, *alt_paths]
+        mask = self._mask
+        if not mask:
+            return
+        paths = [path for path in (self._src_path, self._dest_path, *alt_paths) if path is not None]
         for route in routes:
-            if route.event & self._mask:
+            if route.event & mask:
                 for path in paths:
-                    if path is not None and route.pattern.fullmatch(path):
+                    if route.pattern.fullmatch(path):
                         yield route
                         break
 
+    def _stat_src(self, follow_symlinks: bool = False) -> os.stat_result:
+        """Stat `src_path` at most once (plus once more for a link target); None if missing."""
+        if self._lstat is _NOT_STATED:
+            try:
+                self._lstat = os.lstat(self._src_path)
+            except (OSError, ValueError):
+                self._lstat = None
+        st = self._lstat
+        if follow_symlinks and st is not None and S_ISLNK(st.st_mode):
+            if self._stat is _NOT_STATED:
+                try:
+                    self._stat = os.stat(self._src_path)
+                except (OSError, ValueError):
+                    self._stat = None
+            st = self._stat
+        return st
+
     def select_procs(self) -> None:
-        self._proc = list(LinuxProcess.get_procs_by_filename(os.fsdecode(self._src_path)))
+        self._proc = list(LinuxProcess.get_procs_by_filename(self.src_path))
 
     @property
     def src_path(self):
-        return os.fsdecode(self._src_path)
+        if self._src_str is None:
+            self._src_str = os.fsdecode(self._src_path)
+        return self._src_str
 
     @property
     def dest_path(self):
-        return None if self._dest_path is None else os.fsdecode(self._dest_path)
+        if self._dest_str is None and self._dest_path is not None:
+            self._dest_str = os.fsdecode(self._dest_path)
+        return self._dest_str
 
     @property
     def is_invalid(self):
         """If file has been deleted or changed since event."""
-        return (self._mask & (InotifyConstants.IN_DELETE | InotifyConstants.IN_DELETE_SELF | InotifyConstants.IN_MOVED_FROM) == 0
-                and not osp.exists(self._src_path) and self._dest_path is None) \
-            or (self._mask & InotifyConstants.IN_ISDIR > 0) ^ osp.isdir(self._src_path)
+        st = self._stat_src(follow_symlinks=True)
+        return (self._mask & _INVALID_MASK == 0
+                and st is None and self._dest_path is None) \
+            or (self._mask & InotifyConstants.IN_ISDIR > 0) ^ (st is not None and S_ISDIR(st.st_mode))
 
     @property
     def is_dir(self):
-        return self._mask & InotifyConstants.IN_ISDIR and osp.isdir(self._src_path)
+        if not self._mask & InotifyConstants.IN_ISDIR:
+            return False
+        st = self._stat_src(follow_symlinks=True)
+        return st is not None and S_ISDIR(st.st_mode)
     
     @property
     def is_file(self):
-        return self._mask & InotifyConstants.IN_ISDIR == 0 and osp.isfile(self._src_path)
+        if self._mask & InotifyConstants.IN_ISDIR:
+            return False
+        st = self._stat_src(follow_symlinks=True)
+        return st is not None and S_ISREG(st.st_mode)
     
     @property
     def is_create_file(self):
-        return self.is_file and self._mask & InotifyConstants.IN_CREATE
+        return self._kind & KIND_CREATE_FILE and self.is_file
     
     @property
     def is_modify_file(self):
-        return self.is_file and self._mask & ExtendedInotifyConstants.EX_END_MODIFY
+        return self._kind & KIND_MODIFY_FILE and self.is_file
     
     @property
     def is_moveto_file(self):
-        return self._mask & InotifyConstants.IN_ISDIR == 0 and self._mask & InotifyConstants.IN_MOVED_TO \
+        return self._kind & KIND_MOVETO_FILE \
             and osp.isfile(self.dest_path or self.src_path)
     
     @property
     def is_delete_file(self):
         """If is deletion of file or link."""
-        return self._mask & InotifyConstants.IN_ISDIR == 0 and \
-            self._mask & (InotifyConstants.IN_DELETE | InotifyConstants.IN_MOVED_FROM)
+        return self._kind & KIND_DELETE_FILE
     
+    @property
+    def is_link(self):
+        """
+        If `src_path` is a symbolic link (lstat). Events on links never carry IN_ISDIR,
+        so the `is_*_link` tests check that bit first and skip the syscall for dirs.
+        """
+        st = self._stat_src()
+        return st is not None and S_ISLNK(st.st_mode)
+
     @property
     def is_create_link(self):
-        return osp.islink(self._src_path) and \
-            self._mask & (InotifyConstants.IN_CREATE | InotifyConstants.IN_MOVED_TO)
+        return self._kind & KIND_CREATE_LINK and self.is_link
     
     @property
     def is_modify_link(self):
-        return osp.islink(self._src_path) and \
-            self._mask & InotifyConstants.IN_MODIFY
+        return self._kind & KIND_MODIFY_LINK and self.is_link
     
     @property
     def is_create_dir(self):
-        mask1 = InotifyConstants.IN_ISDIR | InotifyConstants.IN_CREATE
-        mask2 = InotifyConstants.IN_ISDIR | InotifyConstants.IN_MOVED_TO
-        return self._mask & mask1 >= mask1 or self._mask & mask2 >= mask2
+        return self._kind & KIND_CREATE_DIR
     
     @property
     def is_delete_watch(self):
-        return self._mask & InotifyConstants.IN_DELETE_SELF
+        return self._kind & KIND_DELETE_WATCH
     
     @property
     def is_move_watch(self):
-        return self._mask & InotifyConstants.IN_MOVE_SELF
+        return self._kind & KIND_MOVE_WATCH
     
     @property
     def is_attrib_dir(self):
-        mask = InotifyConstants.IN_ISDIR | InotifyConstants.IN_ATTRIB
-        return self._mask & mask >= mask
+        return self._kind & KIND_ATTRIB_DIR
     
     @property
     def is_move_dir(self):
-        mask = InotifyConstants.IN_ISDIR | InotifyConstants.IN_MOVED_FROM
-        return self._mask & mask >= mask
+        return self._kind & KIND_MOVE_DIR
     
     @property
     def is_overflow(self):
@@ -198,26 +389,22 @@ class InotifyEvent:
     @property
     def event_name(self):
         if self._event_name is None:
-            for event in (
-                    'IN_ACCESS', 'IN_MODIFY', 'IN_ATTRIB', 'IN_CLOSE_WRITE',
-                    'IN_CLOSE_NOWRITE','IN_OPEN', 'IN_MOVED_FROM', 'IN_MOVED_TO',
-                    'IN_DELETE', 'IN_CREATE', 'IN_DELETE_SELF', 'IN_MOVE_SELF',
-                    'IN_UNMOUNT', 'IN_Q_OVERFLOW', 'IN_IGNORED'):
-                if self._mask & getattr(InotifyConstants, event):
-                    self._event_name = event
-                    break  # TODO: Is it possible to have multiple user-space events?
+            m = self._mask & _in_event_names_mask
+            if m & (m - 1) == 0:  # at most one user-space event
+                name = _in_event_name_for_bit.get(m)
+            else:  # TODO: Is it possible to have multiple user-space events?
+                name = next(name for bit, name in _in_event_names if m & bit)
+            if name is None:  # extended events only
+                for bit, ex_name in _ex_event_names:
+                    if self._mask & bit:
+                        name = ex_name
+                        break
+            self._event_name = name
         return self._event_name
     
     @property
     def full_event_name(self):
-        masks = []
-        for event in dir(ExtendedInotifyConstants):
-            if not event.startswith('_'):
-                mask = getattr(ExtendedInotifyConstants, event)
-                if self._mask & mask >= mask:
-                    masks.append(event)
-        masks = '|'.join(masks)
-        return masks
+        return _full_event_name(self._mask)
     
     @property
     def event_name_zh(self):
@@ -227,12 +414,12 @@ class InotifyEvent:
         self._fields = {**self._fields, **kwargs}
     
     def get_fields(self) -> dict:
-        src_path = os.fsdecode(self._src_path)
+        src_path = self.src_path
         return {
             'ev_src': src_path,
             'ev_src_ext': os.path.splitext(src_path)[-1],
-            'ev_dest': os.fsdecode(self._dest_path) if self._dest_path is not None else None,
-            'ev_time': datetime.fromtimestamp(self._time),
+            'ev_dest': self.dest_path,
+            'ev_time': _LazyDatetime(self._time),
             'ev_name': self.full_event_name,
             'ev_name_zh': self.event_name_zh,
             **self._fields
@@ -242,10 +429,12 @@ class InotifyEvent:
         return f'{self.__class__.__name__}({self.full_event_name}, {self._src_path}, {self._dest_path}, {self._time})'
 
     def __str__(self):
-        return f'{self.event_name} {os.fsdecode(self._src_path)}'
+        return f'{self.event_name} {self.src_path}'
     
 
 class ExtendedEvent(InotifyEvent):
+    __slots__ = ()
+
     def __init__(self, mask: int, src_path: bytes = b'', dest_path: bytes = None,
                  event_time: float = None, override: int = 0) -> None:
         super().__init__(None, mask, None, None,
@@ -264,13 +453,3 @@ class ExtendedEvent(InotifyEvent):
         )
         return ret
 
-    @property
-    def event_name(self):
-        if super().event_name is None:
-            for event in (
-                    'EX_RENAME', 'EX_MODIFY_CONFIG',
-                    'EX_BEGIN_MODIFY', 'EX_IN_MODIFY', 'EX_END_MODIFY'):
-                if self._mask & getattr(ExtendedInotifyConstants, event):
-                    self._event_name = event
-                    break
-        return self._event_name
@@ -4,8 +4,10 @@
 import macros
 import os
 from datetime import datetime
+from time import time
 import colorama
 from threading import Lock
+import atexit
 
 
 if macros.TEST_OUTFILE:
@@ -17,11 +19,45 @@ if macros.TEST_OUTFILE:
 
 _levels = {level: i for i, level in enumerate(('TRACE', 'DEBUG', 'INFO', 'SUCCESS', 'WARNING', 'ERROR', 'CRITICAL'))}
 
+_level_styles = {
+    'TRACE': (colorama.Fore.LIGHTCYAN_EX, colorama.Fore.RESET),
+    'DEBUG': (colorama.Fore.LIGHTBLUE_EX, colorama.Fore.RESET),
+    'INFO': (colorama.Style.BRIGHT, colorama.Style.NORMAL),
+    'SUCCESS': (colorama.Fore.LIGHTGREEN_EX, colorama.Fore.RESET),
+    'WARNING': (colorama.Fore.LIGHTYELLOW_EX, colorama.Fore.RESET),
+    'ERROR': (colorama.Fore.LIGHTRED_EX, colorama.Fore.RESET),
+    'CRITICAL': (colorama.Back.RED, colorama.Back.RESET),
+}
+
 
 class Logger:
     def __init__(self):
         self._options = None
         self._lock = Lock()
+        self._threshold = _levels[macros.LOG_LEVEL]
+        self._now = (0, '')  # (epoch second, formatted time), updated as a whole by any thread
+        # Lines for `_f`, written out in batches
+        self._buf = []
+        self._buf_time = 0.
+        if macros.TEST_OUTFILE:
+            atexit.register(self._flush)
+
+    def set_level(self, level):
+        """Change `macros.LOG_LEVEL`; assigning it directly does not take effect."""
+        self._threshold = _levels[level]
+        macros.LOG_LEVEL = level
+
+    def enabled_for(self, level):
+        """If messages of `level` will be logged; use it to skip building costly messages."""
+        return _levels[level] >= self._threshold
+
+    @property
+    def trace_enabled(self):
+        return self.enabled_for('TRACE')
+
+    @property
+    def debug_enabled(self):
+        return self.enabled_for('DEBUG')
 
     def trace(__self, __message, *args, **kwargs):  # noqa: N805
         r"""Log ``message.format(*args, **kwargs)`` with severity ``'TRACE'``."""
@@ -52,30 +88,33 @@ class Logger:
         __self._log("CRITICAL", False, __self._options, __message, args, kwargs)
 
     def _log(self, level, from_decorator, options, message, args, kwargs):
-        if _levels[level] < _levels[macros.LOG_LEVEL]:
+        if _levels[level] < self._threshold:
             return
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ansi_set = ''
-        ansi_reset = ''
-        if level == 'TRACE':
-            ansi_set, ansi_reset = colorama.Fore.LIGHTCYAN_EX, colorama.Fore.RESET
-        elif level == 'DEBUG':
-            ansi_set, ansi_reset = colorama.Fore.LIGHTBLUE_EX, colorama.Fore.RESET
-        elif level == 'INFO':
-            ansi_set, ansi_reset = colorama.Style.BRIGHT, colorama.Style.NORMAL
-        elif level == 'SUCCESS':
-            ansi_set, ansi_reset = colorama.Fore.LIGHTGREEN_EX, colorama.Fore.RESET
-        elif level == 'WARNING':
-            ansi_set, ansi_reset = colorama.Fore.LIGHTYELLOW_EX, colorama.Fore.RESET
-        elif level == 'ERROR':
-            ansi_set, ansi_reset = colorama.Fore.LIGHTRED_EX, colorama.Fore.RESET
-        elif level == 'CRITICAL':
-            ansi_set, ansi_reset = colorama.Back.RED, colorama.Back.RESET
-            
+        if args or kwargs:  # formatted only when the message is logged
+            message = message.format(*args, **kwargs)
+        sec = int(time())
+        cached_sec, now = self._now
+        if sec != cached_sec:
+            now = datetime.fromtimestamp(sec).strftime('%Y-%m-%d %H:%M:%S')
+            self._now = (sec, now)
+        ansi_set, ansi_reset = _level_styles.get(level, ('', ''))
         print(f'{colorama.Fore.GREEN}{now}{colorama.Fore.RESET} | {ansi_set}{level:8s}{ansi_reset} | {ansi_set}{message}{ansi_reset}')
         if macros.TEST_OUTFILE:
             with self._lock:
-                print(f'{now} | {level:8s} | {message}', file=_f)
+                self._buf.append(f'{now} | {level:8s} | {message}\n')
+                t = time()
+                if len(self._buf) >= 64 or t - self._buf_time > 0.1:
+                    self._flush_locked()
+                    self._buf_time = t
+
+    def _flush_locked(self):
+        _f.write(''.join(self._buf))
+        _f.flush()
+        self._buf.clear()
+
+    def _flush(self):
+        with self._lock:
+            self._flush_locked()
 
 
 logger = Logger()
\ No newline at end of file
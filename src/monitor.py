@@ -6,11 +6,15 @@ import threading
 import errno
 import os
 import os.path as osp
-import pathlib
 import select
+import fcntl
+import termios
+from array import array
 import sys
+from time import time
 from queue import Queue
-from typing import Iterable, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Tuple, Dict, Any
 from loguru import logger
 from database.conn import SQLEventLogger
 from linux import *
@@ -18,6 +22,9 @@ from tracker import FileTracker
 from dispatcher import BaseDispatcher, Dispatcher, Route
 from controller import MasterController
 from event import *
+from event import (KIND_CREATE_DIR, KIND_ATTRIB_DIR, KIND_MOVE_DIR, KIND_DELETE_WATCH, KIND_MOVE_WATCH,
+                   KIND_DELETE_FILE, KIND_CREATE_FILE, KIND_MODIFY_FILE, KIND_MOVETO_FILE,
+                   KIND_CREATE_LINK, KIND_MODIFY_LINK)
 from buffer import InotifyBuffer
 import settings
 
@@ -25,6 +32,17 @@ import settings
 EVENT_SIZE = ctypes.sizeof(inotify_event_struct)
 DEFAULT_NUM_EVENTS = 2048
 DEFAULT_EVENT_BUFFER_SIZE = DEFAULT_NUM_EVENTS * (EVENT_SIZE + 16)
+MAX_DRAIN_READS = 8  # reads of queued events per wakeup
+STATS_FLUSH_INTERVAL = 0.1  # seconds between sending read / event counts to the controller
+_EVENT_HDR = struct.Struct('iIII')  # wd, mask, cookie, len of `inotify_event_struct`
+_EVENT_HDR_SIZE = _EVENT_HDR.size
+# Events not on a watched path, handled before the others
+_SPECIAL_MASK = InotifyConstants.IN_Q_OVERFLOW | InotifyConstants.IN_IGNORED
+# Kinds of events passed to the file tracker, if on regular files
+_TRACK_KINDS = KIND_CREATE_FILE | KIND_MODIFY_FILE
+# Kinds of events that change the watches
+_WATCH_KINDS = KIND_CREATE_LINK | KIND_MODIFY_LINK | KIND_DELETE_FILE | KIND_CREATE_DIR | KIND_ATTRIB_DIR \
+    | KIND_DELETE_WATCH | KIND_MOVE_DIR | KIND_MOVE_WATCH
 
 
 class Worker(threading.Thread):
@@ -37,52 +55,84 @@ class Worker(threading.Thread):
         self._channel = channel
         self._controller = controller
 
-        self._lock = threading.Lock()
+        # Watches and links are also changed by the controller (e.g., `recover`, `watch`);
+        #   the two are locked separately, and never together
+        self._wd_lock = threading.Lock()
+        self._link_lock = threading.Lock()
         self._signal_r, self._signal_w = os.pipe()
 
         self._fd = inotify_init()
+        self._event_buf = bytearray(DEFAULT_EVENT_BUFFER_SIZE)  # reused by every read
+        self._n_reads = self._n_events = 0  # stats not yet sent to the controller
+        self._stats_time = time()
+        self._event_view = memoryview(self._event_buf)
         self._blocking = settings.worker_blocking_read
         os.set_blocking(self._fd, self._blocking)
+        if not self._blocking:
+            self._epoll = select.epoll()
+            self._epoll.register(self._fd, select.EPOLLIN)
+            self._epoll.register(self._signal_r, select.EPOLLIN)
         self._wd_for_path = {}
         self._path_for_wd = {}
+        self._prefix_for_wd = {}  # path + b'/' of each wd, prepended to the names in its events
         self._mark_for_wd = {}  # states for handling mv dirs
+        # Watched subdirs of each watched dir, so that a subtree is found without a full scan
+        self._children_for_wd = {}
+        self._parent_for_wd = {}
+        self._orphan_wds = set()  # watches whose parent dir is not watched (e.g., roots, link targets)
         # These are used for watching symbolic links
         self._links_for_path = {}  # target -> list of links
         self._path_for_link = {}  # link -> unique target
 
         self._watch_link = watch_link
         self._mask = mask
-        self._db_logger = SQLEventLogger()
-        self._db_logger.init_conn()
+        self._db_logger = SQLEventLogger()  # connects on the first event
 
         self._buffer = InotifyBuffer(self._read_events)
 
         self._init_paths = paths
         logger.debug(f'Worker {self}: Watching {paths} using Inotify instance {self._fd}')
         for path in paths:
-            self._add_dir_watch(os.fsencode(path), self._mask)
+            self._add_dir_watch(os.fsencode(path).rstrip(b'/') or b'/', self._mask)
 
     def start(self):
+        self._db_logger.start()  # before any event is read
         self._buffer.start()
         super().start()
         self._controller.add_worker(self)
-        self._db_logger.start()
 
     @staticmethod
-    def _parse_event_buffer(event_buffer):
+    def _parse_event_buffer(event_buffer, end=None) -> List[Tuple[int, int, int, bytes]]:
+        """Parse `event_buffer[:end]`; names are copied out, so the buffer can be reused afterwards."""
+        unpack_from = _EVENT_HDR.unpack_from
+        view = memoryview(event_buffer)
+        if end is None:
+            end = len(event_buffer)
+        records = []
+        append = records.append
         i = 0
-        while i + 16 <= len(event_buffer):
-            wd, mask, cookie, length = struct.unpack_from("iIII", event_buffer, i)
-            name = event_buffer[i + 16 : i + 16 + length].rstrip(b"\0")
-            i += 16 + length
-            yield wd, mask, cookie, name
+        hdr_size = _EVENT_HDR_SIZE
+        while i + hdr_size <= end:
+            wd, mask, cookie, length = unpack_from(event_buffer, i)
+            i += hdr_size
+            if length:
+                # The name is NUL-terminated and then NUL-padded to `length`
+                j = event_buffer.find(b"\0", i, i + length)
+                append((wd, mask, cookie, view[i : j if j >= 0 else i + length].tobytes()))
+                i += length
+            else:
+                append((wd, mask, cookie, b''))
+        return records
 
     def _read_events(self, event_buffer_size=DEFAULT_EVENT_BUFFER_SIZE):
-        event_buffer = None
+        buffers = [self._event_view[:event_buffer_size]]
+        n_bytes = 0
         if self._blocking:
+            if (self._n_reads or self._n_events) and self._pending_bytes() < EVENT_SIZE:
+                self._flush_stats()  # the read below may block for long
             while True:
                 try:
-                    event_buffer = os.read(self._fd, event_buffer_size)
+                    n_bytes = os.readv(self._fd, buffers)
                 except OSError as e:
                     if e.errno == errno.EINTR:
                         continue
@@ -92,62 +142,116 @@ class Worker(threading.Thread):
                         self._raise(e)
                 break
         else:
-            rlist, _, _ = select.select([self._fd, self._signal_r], [], [])
-            if self._fd not in rlist:
+            # Wake up in time to send the stats of the last reads, even if no more events come
+            timeout = -1
+            if self._n_reads or self._n_events:
+                timeout = max(0., self._stats_time + STATS_FLUSH_INTERVAL - time())
+            try:
+                ready = self._epoll.poll(timeout)
+            except (OSError, ValueError):  # closed by `stop`
+                return []
+            if not ready:
+                self._flush_stats()
+                return []
+            if not any(fd == self._fd for fd, _ in ready):
                 return []
             try:
-                event_buffer = os.read(self._fd, event_buffer_size)
+                n_bytes = os.readv(self._fd, buffers)
             except OSError as e:
                 if e.errno == errno.EBADF:
                     return []
                 else:
                     self._raise(e)
 
-        self._controller.signal_inotify_stats(self._controller.READ)
-
+        # Drain what is already queued in the kernel before handing events over;
+        #   a non-blocking fd is read until EAGAIN, a blocking one asks FIONREAD first
         event_list = []
-        for wd, mask, cookie, name in self._parse_event_buffer(event_buffer):
-            if mask & InotifyConstants.IN_Q_OVERFLOW:
-                self._controller.signal_inotify_stats(self._controller.OVERFlOW)
-                # NOTE: The entire queue is dropped when an overflow occurs
-                # NOTE: Overflow can be triggered by list(os.walk(link_loop, followlinks=True))
-                logger.critical('Queue overflow occurred')
-                event_list.append(InotifyEvent(wd, mask, cookie, name, b''))
-                # Do _add_dir_watch after overflow since IN_ISDIR|IN_CREATE events may be dropped
-                # XXX: Better in separated thread to prevent another overflow?
-                self.recover()
-                logger.success(f'Auto-recover watches after overflow.')
-                continue
-            if mask & InotifyConstants.IN_IGNORED:
-                # logger.warning('Event ignored')
-                event_list.append(InotifyEvent(wd, mask, cookie, name, b''))
+        n_reads = 1
+        blocking = self._blocking
+        while True:
+            self._handle_event_buffer(n_bytes, event_list)
+            if n_reads >= MAX_DRAIN_READS or blocking and self._pending_bytes() < EVENT_SIZE:
+                break
+            try:
+                n_bytes = os.readv(self._fd, buffers)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EBADF):
+                    break
+                self._raise(e)
+            n_reads += 1
+
+        self._n_reads += n_reads
+        self._n_events += len(event_list)
+        if time() - self._stats_time >= STATS_FLUSH_INTERVAL:
+            self._flush_stats()
+        return event_list
+
+    def _flush_stats(self):
+        """Publish read / event counts accumulated since the last flush."""
+        n_reads, n_events = self._n_reads, self._n_events
+        self._n_reads = self._n_events = 0
+        self._stats_time = time()
+        counts = {name: num for name, num in ((self._controller.READ, n_reads), (self._controller.EVENT, n_events)) if num}
+        if counts:
+            self._controller.signal_inotify_stats_bulk(counts)
+
+    def _pending_bytes(self) -> int:
+        buf = array('i', [0])
+        try:
+            fcntl.ioctl(self._fd, termios.FIONREAD, buf)
+        except OSError:
+            return 0
+        return buf[0]
+
+    def _handle_event_buffer(self, n_bytes, event_list):
+        path_for_wd, prefix_for_wd, append = self._path_for_wd, self._prefix_for_wd, event_list.append
+        new_event = InotifyEvent
+        for wd, mask, cookie, name in self._parse_event_buffer(self._event_buf, n_bytes):
+            if mask & _SPECIAL_MASK:
+                if mask & InotifyConstants.IN_Q_OVERFLOW:
+                    self._controller.signal_inotify_stats(self._controller.OVERFlOW)
+                    # NOTE: The entire queue is dropped when an overflow occurs
+                    # NOTE: Overflow can be triggered by list(os.walk(link_loop, followlinks=True))
+                    logger.critical('Queue overflow occurred')
+                    append(InotifyEvent(wd, mask, cookie, name, b''))
+                    # Do _add_dir_watch after overflow since IN_ISDIR|IN_CREATE events may be dropped
+                    # XXX: Better in separated thread to prevent another overflow?
+                    self.recover()
+                    logger.success(f'Auto-recover watches after overflow.')
+                else:  # IN_IGNORED
+                    # logger.warning('Event ignored')
+                    append(InotifyEvent(wd, mask, cookie, name, b''))
                 continue
 
-            if not wd in self._path_for_wd:
+            prefix = prefix_for_wd.get(wd)
+            if prefix is None:
                 continue  # AUTO_RECOVERY: wd may have been removed
-            wd_path = self._path_for_wd[wd]
-            src_path = osp.join(wd_path, name) if name else wd_path  # avoid trailing slash
-            event = InotifyEvent(wd, mask, cookie, name, src_path)
-            event_list.append(event)
+            src_path = prefix + name if name else path_for_wd[wd]
+            event = new_event(wd, mask, cookie, name, src_path)
+            append(event)
+
+            kind = event._kind
+            if not kind & _WATCH_KINDS:
+                continue
 
-            if event.is_create_link:
+            if kind & KIND_CREATE_LINK and event.is_link:
                 self._add_link_watch(src_path, self._mask)
-            elif event.is_modify_link:  # e.g., ln -sfn
+            elif kind & KIND_MODIFY_LINK and event.is_link:  # e.g., ln -sfn
                 self._rm_link_watch(src_path)
                 self._add_link_watch(src_path, self._mask)
-            elif event.is_delete_file and src_path in self._path_for_link:
+            elif kind & KIND_DELETE_FILE and src_path in self._path_for_link:
                 self._rm_link_watch(src_path)
             
-            if event.is_create_dir or event.is_attrib_dir:
+            if kind & (KIND_CREATE_DIR | KIND_ATTRIB_DIR):
                 self._add_dir_watch(src_path, self._mask, event_wd=wd)
             
-            elif event.is_delete_watch:
+            elif kind & KIND_DELETE_WATCH:
                 self._rm_watch(wd)
-            elif event.is_move_dir:  # wd1 IN_MOVED_FROM a
+            elif kind & KIND_MOVE_DIR:  # wd1 IN_MOVED_FROM a
                 wd2 = self._wd_for_path[src_path]
                 self._mark_for_wd[wd] = {'child_wd': wd2}
                 self._mark_for_wd[wd2] = {'parent_wd': wd}
-            elif event.is_move_watch:
+            elif kind & KIND_MOVE_WATCH:
                 if path := self._mark_for_wd[wd].get('to_path'):
                     wd1 = self._mark_for_wd[wd]['parent_wd']
                     self._mark_for_wd[wd1] = None
@@ -156,14 +260,11 @@ class Worker(threading.Thread):
                 else:
                     for sub_wd in list(self._select_subpaths(self._path_for_wd[wd])):
                         self._rm_watch(sub_wd)
-
-        self._controller.signal_inotify_stats(self._controller.EVENT, len(event_list))
-        return event_list
     
     def recover(self):
         self._clean_watch()
         for path in self._init_paths:
-            path = os.fsencode(path)
+            path = os.fsencode(path).rstrip(b'/') or b'/'
             self._add_dir_watch(path, self._mask)
     
     def _add_link_watch(self, src_path, mask):
@@ -183,79 +284,124 @@ class Worker(threading.Thread):
         
         path = src_path
         while osp.islink(path):
-            path = osp.abspath(osp.join(osp.split(path)[0], os.readlink(path)))
+            # Resolve against the dir of the link, as bytes; abspath (and its getcwd) only for relative paths
+            target = os.readlink(path)
+            if not target.startswith(b'/'):
+                target = path[:path.rfind(b'/') + 1] + target
+            path = osp.normpath(target) if target.startswith(b'/') else osp.abspath(target)
             break  # TODO: recursively follow a link and detect possible loops
         dest_path = path
         if osp.islink(dest_path) or not osp.isdir(dest_path):
             return  # TODO: consider linking a file
         
-        if dest_path not in self._links_for_path:
-            self._links_for_path[dest_path] = set()
-            # Add a dummy link marked as None if dest was being watched
-            # so that it will still be watched when the real links are removed
-            if dest_path in self._wd_for_path:
-                self._links_for_path[dest_path].add(None)
-            else:
-                self._add_dir_watch(dest_path, mask)
-        self._links_for_path[dest_path].add(src_path)
-        self._path_for_link[src_path] = dest_path
-        logger.debug(f'links: {self._links_for_path}')
+        add_dest = False
+        with self._link_lock:
+            if dest_path not in self._links_for_path:
+                self._links_for_path[dest_path] = set()
+                # Add a dummy link marked as None if dest was being watched
+                # so that it will still be watched when the real links are removed
+                if dest_path in self._wd_for_path:
+                    self._links_for_path[dest_path].add(None)
+                else:
+                    add_dest = True
+            self._links_for_path[dest_path].add(src_path)
+            self._path_for_link[src_path] = dest_path
+        if add_dest:
+            self._add_dir_watch(dest_path, mask)
+        if logger.debug_enabled:  # per link; skip the call when filtered out
+            logger.debug('links: {}', self._links_for_path)
 
     def _rm_link_watch(self, link):
-        path = self._path_for_link[link]
-        del self._path_for_link[link]
-        self._links_for_path[path].remove(link)
-        if not self._links_for_path[path]:
-            del self._links_for_path[path]
+        with self._link_lock:
+            path = self._path_for_link.pop(link)
+            links = self._links_for_path[path]
+            links.remove(link)
+            if not links:
+                del self._links_for_path[path]
+        if not links:
             self._rm_dir_watch(self._wd_for_path[path])
-        logger.debug(f'links: {self._links_for_path}')
+        if logger.debug_enabled:
+            logger.debug('links: {}', self._links_for_path)
     
     def _add_dir_watch(self, path, mask, event_wd=None):
-        if not osp.isdir(path):
-            logger.warning(f'{path} is not a directory')
-            # raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
-            return
+        # No isdir check first; with IN_ONLYDIR, inotify_add_watch fails with ENOTDIR for non-dirs
+        mask |= InotifyConstants.IN_ONLYDIR
         ret = self._add_watch(path, mask, event_wd=event_wd)
         if not ret:
             return
 
-        # Add subdirs
-        for root, dirnames, _ in os.walk(path):
-            for dirname in dirnames:
-                full_path = osp.join(root, dirname)
-                if not osp.islink(full_path):
-                    self._add_watch(full_path, mask, event_wd=event_wd)
-
-        # Add links
-        for root, dirnames, filenames in os.walk(path):
-            for dirname in dirnames:
-                full_path = osp.join(root, dirname)
-                if osp.islink(full_path):
-                    self._add_link_watch(full_path, mask)
-            for filename in filenames:
-                full_path = osp.join(root, filename)
-                if osp.islink(full_path):
-                    self._add_link_watch(full_path, mask)
+        # Add subdirs, then links, so that links into the tree find their targets watched
+        add_watch = self._add_watch
+        links = []
+        n_threads = int(settings.worker_scan_threads)
+        if n_threads > 1 and event_wd is None:
+            scans = self._scan_tree_parallel(path, n_threads)
+        else:
+            scans = self._scan_tree(path)
+        for dirs, dir_links in scans:
+            for full_path in dirs:
+                add_watch(full_path, mask, event_wd=event_wd)
+            links.extend(dir_links)
+
+        add_link_watch = self._add_link_watch
+        for full_path in links:
+            add_link_watch(full_path, mask)
+
+    @staticmethod
+    def _scan_tree(path) -> Iterator[Tuple[List[bytes], List[bytes]]]:
+        """
+        Walk the tree under `path` top-down without following links, yielding
+        the real subdirs and the links (to dirs or files) of each directory.
+        Unreadable directories are skipped, as in `os.walk`.
+        """
+        stack = [path]
+        while stack:
+            root = stack.pop()
+            dirs, links = [], []
+            try:
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_symlink():
+                                links.append(entry.path)
+                            elif entry.is_dir(follow_symlinks=False):
+                                dirs.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            yield dirs, links
+            stack.extend(reversed(dirs))
+
+    @classmethod
+    def _scan_tree_parallel(cls, path, n_threads) -> Iterator[Tuple[List[bytes], List[bytes]]]:
+        """Same as `_scan_tree`, but subtrees of `path` are scanned in a thread pool."""
+        tree = cls._scan_tree(path)
+        top = next(tree, None)
+        tree.close()
+        if top is None:
+            return
+        yield top
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for scans in pool.map(lambda subdir: list(cls._scan_tree(subdir)), top[0]):
+                yield from scans
 
     def _rm_dir_watch(self, wd):
-        path = self._path_for_wd[wd]
-        self._rm_watch(wd)
-        
-        for root, dirnames, _ in os.walk(path):
-            for dirname in dirnames:
-                full_path = osp.join(root, dirname)
-                if not osp.islink(full_path):
-                    if not full_path in self._wd_for_path:
-                        continue  # AUTO_RECOVERY:
-                    self._rm_watch(self._wd_for_path[full_path])
-                # TODO: Remove links in the dir
+        # Found from the watch table rather than the filesystem, which may be gone already
+        for sub_wd in list(self._select_subpaths(self._path_for_wd[wd])):
+            self._rm_watch(sub_wd)
+        # TODO: Remove links in the dir
 
     def _clean_watch(self):
         for wd in list(self._path_for_wd):
             self._rm_watch(wd)
         
     def _add_watch(self, path, mask, event_wd=None):
+        assert path == b'/' or not path.endswith(b'/'), path
         if path in self._wd_for_path:
+            # May be watched before its parent (e.g., as a link target)
+            with self._wd_lock:
+                self._link_watch(self._wd_for_path[path], path)
             if not os.access(path, os.R_OK):
                 logger.warning(f'{path} lost permissions')
                 for rm_wd in list(self._select_subpaths(path)):
@@ -273,9 +419,9 @@ class Worker(threading.Thread):
                 return
             elif err == errno.EEXIST:
                 # wd1 IN_MOVED_TO b
-                wd1 = event_wd
-                if 'child_wd' in self._mark_for_wd[wd1]:  # make sure we already have wd1 IN_MOVED_FROM a
-                    wd2 = self._mark_for_wd[wd1]['child_wd']
+                mark = self._mark_for_wd.get(event_wd)
+                if mark and 'child_wd' in mark:  # make sure we already have wd1 IN_MOVED_FROM a
+                    wd2 = mark['child_wd']
                     self._mark_for_wd[wd2]['to_path'] = path
                     return
                 logger.warning(f'{path} has already been watched')
@@ -288,31 +434,73 @@ class Worker(threading.Thread):
                 '(check https://www.man7.org/linux/man-pages/man2/inotify_add_watch.2.html#ERRORS for details)'))
         elif wd in self._path_for_wd:  # Changed
             pass
-        self._wd_for_path[path] = wd
-        self._path_for_wd[wd] = path
-        self._mark_for_wd[wd] = None
+        with self._wd_lock:
+            self._wd_for_path[path] = wd
+            self._path_for_wd[wd] = path
+            self._prefix_for_wd[wd] = self._path_prefix(path)
+            self._mark_for_wd[wd] = None
+            self._link_watch(wd, path)
         # logger.debug(f'wd: {self._path_for_wd}')
         return True
 
     def _rm_watch(self, wd):
         inotify_rm_watch(self._fd, wd)
-        path = self._path_for_wd[wd]
-        del self._wd_for_path[path]
-        del self._path_for_wd[wd]
-        del self._mark_for_wd[wd]
+        with self._wd_lock:
+            path = self._path_for_wd[wd]
+            del self._wd_for_path[path]
+            del self._path_for_wd[wd]
+            del self._prefix_for_wd[wd]
+            del self._mark_for_wd[wd]
+            self._unlink_watch(wd)
+            self._orphan_wds.discard(wd)
+            for child_wd in self._children_for_wd.pop(wd, ()):
+                del self._parent_for_wd[child_wd]
+                self._orphan_wds.add(child_wd)
         # logger.debug(f'wd: {self._path_for_wd}')
 
     def _mv_watch(self, wd, path):
-        p = self._path_for_wd[wd]
-        del self._wd_for_path[p]
-        self._path_for_wd[wd] = path
-        self._wd_for_path[path] = wd
-        self._mark_for_wd[wd] = None
+        with self._wd_lock:
+            p = self._path_for_wd[wd]
+            del self._wd_for_path[p]
+            self._path_for_wd[wd] = path
+            self._prefix_for_wd[wd] = self._path_prefix(path)
+            self._wd_for_path[path] = wd
+            self._mark_for_wd[wd] = None
+            self._link_watch(wd, path)
+
+    @staticmethod
+    def _path_prefix(path):
+        # Watched paths have no trailing slash except the root
+        return path if path == b'/' else path + b'/'
+
+    def _link_watch(self, wd, path):
+        """Record `wd` as a child of the watch on the parent dir of `path`, if any."""
+        parent_wd = self._wd_for_path.get(osp.dirname(path))
+        if parent_wd == wd:  # the root
+            parent_wd = None
+        if parent_wd is None:
+            self._orphan_wds.add(wd)
+        else:
+            self._orphan_wds.discard(wd)
+        if parent_wd == self._parent_for_wd.get(wd):
+            return
+        self._unlink_watch(wd)
+        if parent_wd is not None:
+            self._parent_for_wd[wd] = parent_wd
+            self._children_for_wd.setdefault(parent_wd, set()).add(wd)
+
+    def _unlink_watch(self, wd):
+        parent_wd = self._parent_for_wd.pop(wd, None)
+        if parent_wd is not None:
+            self._children_for_wd[parent_wd].discard(wd)
 
     def _emit(self, event):
-        for route in event.select_routes(self._channel.routes,
-                                         alt_paths=self._resolve_links(event.src_path, event.dest_path)):
-            self._channel.emit(route, **event.get_fields())
+        fields = None
+        for route in self._channel.select_routes_fast(
+                event, alt_paths=self._resolve_links(event._src_path, event._dest_path)):
+            if fields is None:  # only built when some route matches
+                fields = event.get_fields()
+            self._channel.emit(route, **fields)
 
     def run(self):
         while not self._stopped_event.is_set():
@@ -321,9 +509,10 @@ class Worker(threading.Thread):
                 self._emit(event)
                 self._db_logger.log_event(event)
 
-                if event.is_create_file or event.is_modify_file:
+                kind = event._kind
+                if kind & _TRACK_KINDS and event.is_file:  # is_create_file or is_modify_file
                     self._controller._tracker.watch_or_compare(event.src_path, self._buffer._queue.put)
-                elif event.is_moveto_file:
+                elif kind & KIND_MOVETO_FILE and event.is_moveto_file:
                     # Watch dest `b` if `mv a b`; or watch src `b` if `mv ../a b`
                     self._controller._tracker.watch_or_compare(
                         event.dest_path or event.src_path, self._buffer._queue.put)
@@ -336,12 +525,19 @@ class Worker(threading.Thread):
         self._db_logger.stop()
         self._stopped_event.set()
         self._buffer.stop()
+        self._flush_stats()
 
         os.write(self._signal_w, b' ')
         os.close(self._fd)
+        if not self._blocking:
+            self._epoll.close()
         self._wd_for_path = {}
         self._path_for_wd = {}
+        self._prefix_for_wd = {}
         self._mark_for_wd = {}
+        self._children_for_wd = {}
+        self._parent_for_wd = {}
+        self._orphan_wds = set()
         self._links_for_path = {}
         self._path_for_link = {}
 
@@ -350,37 +546,38 @@ class Worker(threading.Thread):
         self.stop()
         raise(e)
     
-    @staticmethod
-    def _bytes_to_path(b: bytes) -> pathlib.Path:
-        return pathlib.Path(os.fsdecode(b))
-    
     def _select_subpaths(self, parent, new_parent=None) -> Iterable:
-        data = self._path_for_wd
-        parent = self._bytes_to_path(parent)
-        new_parent = self._bytes_to_path(new_parent) if new_parent else None
-        for k, v in data.items():
-            try:
-                rel = self._bytes_to_path(v).relative_to(parent)
-            except:
-                continue
-            if new_parent:
-                yield k, os.fsencode(str(new_parent / rel))
-            else:
-                yield k
+        """Yield the wds of `parent` and the watched dirs under it, parents first,
+        along with the path each one has under `new_parent` if given. The subtree is
+        walked through `_children_for_wd`, so it costs O(subtree), not O(watches);
+        watches under an unwatched dir are found among `_orphan_wds`."""
+        n = len(parent)  # neither path ends with a slash, and the root is never moved
+        path_for_wd, children_for_wd = self._path_for_wd, self._children_for_wd
+        prefix = self._path_prefix(parent)
+        root_wd = self._wd_for_path.get(parent)
+        roots = [] if root_wd is None else [root_wd]
+        roots += sorted((wd for wd in self._orphan_wds if wd != root_wd and path_for_wd[wd].startswith(prefix)),
+                        key=lambda wd: len(path_for_wd[wd]))  # shallower ones first
+        for root_wd in roots:
+            stack = [root_wd]
+            while stack:
+                wd = stack.pop()
+                if new_parent is None:
+                    yield wd
+                else:
+                    yield wd, new_parent + path_for_wd[wd][n:]
+                stack.extend(children_for_wd.get(wd, ()))
 
     def _resolve_links(self, *paths) -> Iterable:
+        """Yield `paths` as seen through watched links, as bytes to match route patterns."""
         for path in paths:
             if not path:
                 break
-            path = pathlib.Path(path)
             for link, dest in self._path_for_link.items():
-                link = self._bytes_to_path(link)
-                dest = self._bytes_to_path(dest)
-                try:
-                    rel = path.relative_to(dest)
-                except:
-                    continue
-                yield str(link / rel)
+                if path == dest:
+                    yield link
+                elif path.startswith(dest if dest.endswith(b'/') else dest + b'/'):
+                    yield link + path[len(dest.rstrip(b'/')):]
 
     @property
     def is_crashed(self):
@@ -402,6 +599,8 @@ def main(args):
     for route in dispatcher.routes:
         mask |= route.event & ~ExtendedInotifyConstants.EX_ALL_EX_EVENTS
     mask |= Route.parse_mask_from_str(settings.worker_extra_mask)
+    if settings.worker_excl_unlink:
+        mask |= InotifyConstants.IN_EXCL_UNLINK
         
     logger.info(f'Using Inotify mask 0x{mask:08x} ({ExtendedEvent(mask).full_event_name})')
 
@@ -1,7 +1,7 @@
 from threading import Thread, Lock, Event
 from time import time
 from datetime import datetime
-from collections import deque
+from collections import deque, Counter
 from typing import Union, Iterable, Callable, Hashable, Any
 from loguru import logger
 
@@ -31,6 +31,7 @@ class SlidingAverageMeter(BaseMeter):
     def __init__(self, duration: Union[int, float]) -> None:
         super().__init__()
         self._queue = deque()
+        self._sum = 0  # sum of values in `_queue`, kept up to date on append / expiry
         self._duration = duration
 
     @property
@@ -44,34 +45,39 @@ class SlidingAverageMeter(BaseMeter):
 
     def update(self, value: Union[int, float] = None) -> None:
         now = time()
+        queue = self._queue
         if value is not None:
-            self._queue.append((now, value))
-        while self._queue and self._queue[0][0] <= now - self._duration:
-            self._queue.popleft()
+            queue.append((now, value))
+            self._sum += value
+        expire = now - self._duration
+        while queue and queue[0][0] <= expire:
+            self._sum -= queue.popleft()[1]
 
     def get(self) -> dict:
         self.update()
-        tot = sum(x[1] for x in self._queue)
+        tot = self._sum
         avg = tot / (len(self._queue) + EPS)
         self._prev = {'sum': tot, 'avg': avg}
         return self._prev
 
 
 class HistogramMeter(BaseMeter):
-    def __init__(self, key: str) -> None:
+    def __init__(self, key: str, collect_raw: bool = True) -> None:
         super().__init__()
-        self._data = {}
+        self._counts = Counter()
+        self._data = {}  # key -> list of values, only if `collect_raw`
         self._key = key
         self._cnt = 0
         self._tic = self._toc = time()
+        self.collect_raw = collect_raw
 
     def update(self, value = None) -> None:
         self._toc = time()
         if value is not None:
             k = value[self._key]
-            if k not in self._data:
-                self._data[k] = []
-            self._data[k].append(value)
+            self._counts[k] += 1
+            if self.collect_raw:
+                self._data.setdefault(k, []).append(value)
             self._cnt += 1
 
     def get(self) -> dict:
@@ -79,10 +85,11 @@ class HistogramMeter(BaseMeter):
         self._prev = {
             'stats_from_time': datetime.fromtimestamp(self._tic),
             'stats_to_time': datetime.fromtimestamp(self._toc),
-            'stats_all': self._data,
-            'stats_histogram': {k: len(self._data[k]) for k in self._data},
+            'stats_all': self._data if self.collect_raw else None,
+            'stats_histogram': dict(self._counts),
             'stats_count': self._cnt
         }
+        self._counts = Counter()
         self._data = {}
         self._cnt = 0
         self._tic = self._toc
@@ -145,7 +152,7 @@ class IntervalScheduler(BaseScheduler):
                 _prev_interval = self._interval
                 self.scale_interval(2**(-priority))
                 if self._interval != _prev_interval:
-                    logger.debug(f'{self} Interval {_prev_interval} -> {self._interval}')
+                    logger.debug('{} Interval {} -> {}', self, _prev_interval, self._interval)
 
                 now = time()
                 timeout = self._cur_time + self._interval - now
@@ -180,19 +187,29 @@ class HistogramScheduler(BaseScheduler):
     def __init__(self, callback: Callable,
                  capacity: int = 100, interval: int = None,
                  stats_key: str = 'ev_name') -> None:
+        self._stats = HistogramMeter(stats_key)  # before `route` is set
         super().__init__(callback)
 
         self._capacity = capacity
         self._interval = interval
         if interval is not None:
             self._interval = interval if interval > 0 else None
-        self._stats = HistogramMeter(stats_key)
 
         self._lock = Lock()
         self._stopped_event = Event()
         self._timeout_event = Event()
         self._cur_time = 0
 
+    @property
+    def route(self):
+        return self._route
+
+    @route.setter
+    def route(self, route) -> None:
+        # Keep the raw values of each key only if the route formats them
+        self._route = route
+        self._stats.collect_raw = route is None or 'stats_all' in route.format
+
     def start(self) -> None:
         self._cur_time = time()
         super().start()
@@ -202,8 +219,9 @@ class HistogramScheduler(BaseScheduler):
         while not self._stopped_event.is_set():
             if not self._timeout_event.wait(timeout):
                 self._cur_time = time()
-                data = self._stats.get()
-                if self._stats.size:  # NOTE: only send non-empty data
+                with self._lock:
+                    data = self._stats.get()
+                if data['stats_count']:  # NOTE: only send non-empty data
                     self._callback(self.route, data)
 
                 now = time()
@@ -218,11 +236,15 @@ class HistogramScheduler(BaseScheduler):
         self._stopped_event.set()
 
     def put(self, value) -> None:
-        self._stats.update(value)
-        if self._capacity > 0 and self._stats.size >= self._capacity:
-            data = self._stats.get()
+        data = None
+        with self._lock:
+            self._stats.update(value)
+            if self._capacity > 0 and self._stats.size >= self._capacity:
+                data = self._stats.get()
+                self._timeout_event.set()
+        # Emit outside the lock, so other producers are not blocked by dispatching
+        if data is not None:
             self._callback(self.route, data)
-            self._timeout_event.set()
 
 
 class ProxyScheduler(BaseScheduler):
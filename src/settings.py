@@ -63,7 +63,10 @@ def _ol(*data, **kwargs):
 worker_every_path = _ob(False, "If true, use one worker thread (along with one inotify instance) for each of `paths`")
 worker_extra_mask = _o('',
     help="Additional inotify events to be recorded into database; if not set, only `route_events` are recorded")
+worker_excl_unlink = _ob(True, "If true, add IN_EXCL_UNLINK to the inotify mask, "
+                              "so files that are unlinked but still open no longer generate events")
 worker_blocking_read = False  # blocking inotify IO / non-blocking inotify IO; both are OK"
+worker_scan_threads = _o(1, help="Threads scanning the subdirs of each path when adding (or recovering) initial watches")
 
 # For file tracking
 tracker_patterns = _ol(r'.*\.(ini|INI)', r'.*\.(json|JSON)', r'.*\.(txt|TXT)', help="The regex patterns of M types of files")
@@ -89,6 +92,9 @@ route_schedulers = _ol('direct', 'direct', 'direct',
          "'histogram' can have 3 sub options")
 route_default_group = _o('', help="Send messages of all tags to this group by default, if `route_groups` not set")
 route_groups = {}  # NOTE: if `tag in route_groups`, send `tag` to that list of groups, otherwise send to default
+route_match_cachesize = _o(4096, help="Size of the LRU cache of pattern match results of each route; 0 to disable")
+route_hyperscan = _ob(False, "Match all route patterns in one pass with hyperscan, if it is installed; "
+                             "hyperscan syntax differs from python `re` for some patterns (e.g., `{,n}`, `\\Z`, backrefs)")
 
 # For controller
 controller_basic_interval = _o(600, help="The interval (seconds) to check worker status")
@@ -97,6 +103,8 @@ controller_limit_threshold = _o(0.9, help="Send alert if used inotify instances
 
 # For delay queue
 buffer_queue_delay = _o(0.5, help="The time (seconds) to leave IN_MOVED_FROM, IN_MODIFY in delay queue for event matching")
+buffer_coalesce_modify = _ob(False, "Drop the intermediate IN_MODIFY events of consecutive writes to a file, "
+                                   "keeping only the first (EX_BEGIN_MODIFY) and the last (EX_END_MODIFY)")
 
 # For database
 db_enabled = _ob(True, "Enable / disable database")
@@ -104,6 +112,8 @@ db_host = 'localhost'
 db_user = 'root'
 db_password = 'password'
 db_database = 'fswatch_db'
+db_log_linger = _o(0.05, help="Seconds to wait for more events before recording them into database in one transaction; "
+                              "0 to record at once")
 
 # For debug only
 external_libs = _ol(dtype=str, help="External python lib paths to be appended to sys.path")
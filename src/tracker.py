@@ -8,7 +8,7 @@ import configparser
 import json
 import utils
 import warnings
-from typing import Dict, List, Tuple, TypeVar, Iterator
+from typing import Dict, List, Tuple, Type, TypeVar, Iterator
 from threading import Thread, Lock
 from loguru import logger
 from database.conn import SQLConnection, SQLConnectionPool
@@ -381,7 +381,7 @@ class BaseFileTracker:
     """
     # TODO: (Optional) Optimize diff tree, e.g., 1 -> 2 -> 1 could be 2 <- 1 -> 1
     def __init__(self) -> None:
-        self._patterns = settings.tracker_patterns
+        self._patterns = [re.compile(pattern) for pattern in settings.tracker_patterns]
         self._filetypes: List[BaseFile] = [_name_to_type[name] for name in settings.tracker_filetypes]
         self._max_depth = settings.tracker_depth
 
@@ -473,15 +473,23 @@ class BaseFileTracker:
     
     # Operations
 
-    def _match_pattern(self, path: str) -> BaseFile:
+    def _match_filetype(self, path: str) -> Type[BaseFile]:
+        abspath, relpath = osp.abspath(path), osp.relpath(path)
         for pattern, filetype in zip(
                 self._patterns, self._filetypes):
-            if re.fullmatch(pattern, osp.abspath(path)) or \
-                    re.fullmatch(pattern, osp.relpath(path)):
-                return filetype.from_file(path)
+            if pattern.fullmatch(abspath) or pattern.fullmatch(relpath):
+                return filetype
+
+    def _match_pattern(self, path: str) -> BaseFile:
+        filetype = self._match_filetype(path)
+        if filetype is not None:
+            return filetype.from_file(path)
     
     @skip_disabled
     def watch_or_compare(self, path: str, callback: callable = None) -> Thread:
+        # Most events are on untracked files; skip them before starting a thread
+        if self._match_filetype(path) is None:
+            return None
         thread = Thread(target=self._watch_or_compare, args=(path, callback))
         thread.start()
         return thread
@@ -506,7 +514,7 @@ class BaseFileTracker:
         else:
             self._watch_file(cfg)
 
-        if macros.TEST_TRACKER_DELAY:
+        if macros.TEST_TRACKER_DELAY and logger.trace_enabled:
             elapsed = time() - tic
             logger.trace(f'Tracker used {elapsed} secs processing {path}')
 
@@ -44,6 +44,30 @@ def format(s, **kwargs):
     return _fmt.format(s, **kwargs)
 
 
+def compile_format(s):
+    """Compile `s` into a function `f` such that `f(data) == format(s, **data)`.
+
+    The template is parsed once and turned into straight-line code; templates with
+    positional fields, attribute / index lookups or nested specs use `format` instead.
+    """
+    parts = []
+    for literal, field_name, format_spec, conversion in _fmt.parse(s):
+        if literal:
+            parts.append(repr(literal))
+        if field_name is None:
+            continue
+        if not field_name.isidentifier() or '{' in format_spec:
+            return lambda data: _fmt.format(s, **data)
+        value = f'data[{field_name!r}]'
+        if conversion:
+            value = f'_fmt.convert_field({value}, {conversion!r})'
+        parts.append(f'_fmt.format_field({value}, {format_spec!r})')
+    namespace = {'_fmt': _fmt}
+    exec(f"def _format(data):\n    return ''.join(({', '.join(parts)},))" if parts else
+         "def _format(data):\n    return ''", namespace)
+    return namespace['_format']
+
+
 def treeify(obj: dict, indent=4, headers=None, show_empty=False):
     headers = headers or []
     headers = {i: h for i, h in enumerate(headers)}